@@ -1,11 +1,16 @@
 import os
 import time
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from pony import orm
 import logging
 import requests
-from dragon_rest.dragons import DragonAPI
-import routeros_api
-from influxdb_client import InfluxDBClient, Point
+from metrics import get_metrics_sink
+from miners import get_driver
+from health import HostHealthTracker
 
 
 class AsicAgent:
@@ -15,7 +20,8 @@ class AsicAgent:
         self.url = os.getenv('URL') or URL
         self.endpoints = {
             'GET': {
-                'available_power': f'{self.url}/get_power'
+                'available_power': f'{self.url}/get_power',
+                'readiness': f'{self.url}/next_step_readiness'
             },
             'UPDATE': {
                 'active_power': f'{self.url}/set_active_power'
@@ -31,6 +37,18 @@ class AsicAgent:
             else RESET_ASIC_TIMEOUT
         self.mikrotik_access_timeout = int(os.getenv('MIKROTIK_ACCESS_TIMEOUT')) if os.getenv('MIKROTIK_ACCESS_TIMEOUT') \
             else MIKROTIK_ACCESS_TIMEOUT
+        self.ramp_wave_size = int(os.getenv('RAMP_WAVE_SIZE')) if os.getenv('RAMP_WAVE_SIZE') else RAMP_WAVE_SIZE
+        self.ramp_wave_timeout = int(os.getenv('RAMP_WAVE_TIMEOUT')) if os.getenv('RAMP_WAVE_TIMEOUT') \
+            else RAMP_WAVE_TIMEOUT
+        self.fetch_timeout = int(os.getenv('FETCH_TIMEOUT')) if os.getenv('FETCH_TIMEOUT') else FETCH_TIMEOUT
+        self.readiness_timeout = int(os.getenv('READINESS_TIMEOUT')) if os.getenv('READINESS_TIMEOUT') \
+            else READINESS_TIMEOUT
+        # By default switching covers a readiness check or concurrent restarts and a call to the router
+        self.switch_timeout = int(os.getenv('SWITCH_TIMEOUT')) if os.getenv('SWITCH_TIMEOUT') \
+            else max(self.readiness_timeout, self.reset_asic_timeout) + self.mikrotik_access_timeout
+        self.logs_timeout = int(os.getenv('LOGS_TIMEOUT')) if os.getenv('LOGS_TIMEOUT') else LOGS_TIMEOUT
+        self.power_stale_timeout = int(os.getenv('POWER_STALE_TIMEOUT')) if os.getenv('POWER_STALE_TIMEOUT') \
+            else POWER_STALE_TIMEOUT
         self.influxdb = {
             'scheme': os.getenv('INFLUX_SCHEME'),
             'host': os.getenv('INFLUX_HOST'),
@@ -40,18 +58,43 @@ class AsicAgent:
             'bucket': os.getenv('INFLUX_BUCKET')
         } if os.getenv('INFLUX_HOST') else INFLUXDB
 
-        # Establishing connection with InfluxDB
-        self.influxdb_client = InfluxDBClient(
-            url=f"{self.influxdb['scheme']}://{self.influxdb['host']}:{self.influxdb['port']}",
-            token=self.influxdb['token'],
-            org=self.influxdb['org']
-        )
-        # InfluxDB write API
-        self.influxdb_write_api = self.influxdb_client.write_api()
+        self.metrics_sink = os.getenv('METRICS_SINK') or METRICS_SINK
+        self.metrics_file = os.getenv('METRICS_FILE') or METRICS_FILE
+
+        # Creating a sink for metrics, its client library is imported only when the sink is used
+        self.metrics = get_metrics_sink(self.metrics_sink, influxdb=self.influxdb, path=self.metrics_file)
+
+        # Ramp-up pipeline: ASICs waiting to be enabled, the wave that is currently starting up and available power
+        # at which metered power has reached available power (nothing is enabled until there's more power)
+        self.ramp_up = {
+            'pending': deque(),
+            'wave': [],
+            'started': 0,
+            'capped_at': None
+        }
+
+        # Worker threads for blocking steps of a tick, at most one thread per step
+        self.executor = ThreadPoolExecutor(max_workers=5)
+        # Worker threads for shutting down ASICs of a power group concurrently
+        self.shutdown_executor = ThreadPoolExecutor(max_workers=16)
+        # Connection to Mikrotik's router, it's kept between calls and shared by threads
+        self.routeros = None
+        self.routeros_lock = threading.Lock()
+        # Persistent HTTP session for API requests
+        self.session = requests.Session()
+        # Futures of the last run of each step
+        self.phases = {}
+        # Tick drift and durations of steps of the last tick (in seconds)
+        self.tick_stats = {}
+        # Time when available power was fetched the last time
+        self.power_updated = time.monotonic()
 
         # Generating DB mapping
         db.generate_mapping(create_tables=True)
 
+        # Tracking health of ASICs, HEALTH_* settings are read by the tracker
+        self.health = HostHealthTracker(HostHealth, self.reset_asic_timeout)
+
         # Flushing firewall rules and shutting down all ASIC
         self.flush_access_rules()
         self.shutdown_all_asics()
@@ -65,50 +108,362 @@ class AsicAgent:
             4. Compare current power consumption with available power
             5. Disable/Enable ASICs if necessary
             5.1 Enabling an ASIC consists of enabling internet access for the ASIC
+                A power group is enabled in waves of RAMP_WAVE_SIZE ASICs, the next wave starts
+                once the previous one is mining or RAMP_WAVE_TIMEOUT has passed and only if it fits available power.
+                A partially started power group (e.g. after a cancelled ramp-up) is finished before other groups
             5.2 Disabling an ASIC consists of disabling internet access for the ASIC and restarting CGMiner
-            6. GOTO 1
+            6. Wait for the next tick and GOTO 1
+
+            Ticks start every SLEEP_TIMER seconds regardless of how long the work takes.
+            Steps 1-3 run concurrently, each step has its own time budget (FETCH_TIMEOUT, SWITCH_TIMEOUT,
+            LOGS_TIMEOUT) and a step which overruns its budget is skipped until it finishes.
+            If available power can't be fetched, ASICs are left as they are for up to POWER_STALE_TIMEOUT,
+            after that they're shed as if there was no available power.
+            After switching, the agent's state (active power, decision, tick timings) is sent to API.
         """
+        asyncio.run(self.control_loop())
+
+    async def control_loop(self):
+        """
+        Runs ticks at a fixed cadence and keeps track of tick drift
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+
         while True:
-            # TODO: Add hysteresis for enabling ASICS
-            # Getting available and active power
-            available_power = self.get_available_power()
-            active_power = self.get_active_power()
+            # Measuring how late the tick has started
+            self.tick_stats['drift'] = round(loop.time() - next_tick, 3)
+
+            await self.tick()
 
-            # Updating PowerGroup table
-            self.update_power_groups()
+            # Scheduling the next tick, ticks which were missed due to an overrun are skipped
+            next_tick += self.sleep_timer
+            now = loop.time()
 
+            if now > next_tick:
+                skipped = int((now - next_tick) // self.sleep_timer) + 1
+                logging.warning(f"Tick overran by {round(now - next_tick, 3)}s, skipping {skipped} tick(s)")
+                next_tick += skipped * self.sleep_timer
+
+            # Sleeping before the next iteration
+            await asyncio.sleep(next_tick - loop.time())
+
+    async def tick(self):
+        """
+        Runs a single iteration of the control loop
+        """
+        # TODO: Add hysteresis for enabling ASICS
+        # Getting available and active power concurrently, active power also updates PowerGroup table
+        (fetched, available_power), (read, active_power) = await asyncio.gather(
+            self.run_phase('fetch', self.fetch_timeout, self.get_available_power),
+            self.run_phase('read', self.fetch_timeout, self.read_power_state)
+        )
+
+        if fetched and available_power is not None:
+            self.power_updated = time.monotonic()
+        elif time.monotonic() - self.power_updated > self.power_stale_timeout:
+            # Falling back to shedding ASICs if available power has been unknown for too long
+            logging.error(f"Available power is unknown for over {self.power_stale_timeout}s, shedding ASICs")
+            available_power = 0
+
+        if read and available_power is not None:
             logging.info(f"Available power: {available_power}")
             logging.info(f"Active power: {active_power}")
 
-            # Checking available power against active power
-            if available_power >= active_power:
-                # Fetching a random power group with the attribute online='False'
-                power_group = self.get_random_power_group(online='False')
-
-                # Checking whether there's a power group available, and we have enough available power to turn it on
-                if power_group is not None and available_power - active_power > power_group.total_power:
-                    # Iterating through members of a power group to turn them on
-                    for member in self.get_power_group_members(power_group.id):
-                        self.enable_asic(
-                            member.ip, member.port,
-                            member.user, member.password
-                        )
+            # Enabling/disabling ASICs
+            switched, decision = await self.run_phase(
+                'switch', self.switch_timeout, self.switch_asics, available_power, active_power
+            )
+
+            state = {
+                'time': time.time(),
+                'available_power': available_power,
+                'active_power': decision['active_power'] if switched else active_power,
+                'decision': decision,
+                'ramp_up': {
+                    'pending': len(self.ramp_up['pending']),
+                    'wave': list(self.ramp_up['wave'])
+                },
+                'tick': dict(self.tick_stats)
+            }
+
+            # Sending stats to the metrics sink and the agent's state to API concurrently
+            await asyncio.gather(
+                self.run_phase('logs', self.logs_timeout, self.write_logs, available_power, state['active_power']),
+                self.run_phase('publish', self.logs_timeout, self.publish_state, state)
+            )
+        else:
+            logging.warning("Available or active power isn't known, skipping the tick")
+
+    async def run_phase(self, name, timeout, func, *args):
+        """
+        Runs a blocking step of a tick in a worker thread within its time budget
+        A step which is still running from a previous tick isn't started again
+
+        Parameters
+        ----------
+        name
+            A name of the step
+        timeout
+            A time budget of the step (in seconds)
+        func
+            A function to run
+        args
+            Arguments of the function
+
+        Returns
+        -------
+        output
+            A tuple of a flag whether the step has finished in time and its result
+        """
+        pending = self.phases.get(name)
+
+        if pending is not None and not pending.done():
+            logging.warning(f"Step '{name}' is still running since the previous tick, skipping it")
+            return False, None
+
+        started = time.monotonic()
+        future = self.executor.submit(func, *args)
+        self.phases[name] = future
+
+        done, _ = await asyncio.wait([asyncio.wrap_future(future)], timeout=timeout)
+        self.tick_stats[name] = round(time.monotonic() - started, 3)
+
+        if not done:
+            logging.warning(f"Step '{name}' has overrun its budget of {timeout}s")
+            return False, None
+
+        try:
+            return True, future.result()
+        except Exception as e:
+            logging.error(f"Error in step '{name}': {e}")
+            return False, None
+
+    def read_power_state(self):
+        """
+        Updates PowerGroups table and returns active power
+
+        Returns
+        -------
+        active_power
+            A number representing active power (in Watts)
+        """
+        active_power = self.get_active_power()
+
+        # Updating PowerGroup table
+        self.update_power_groups()
+
+        return active_power
+
+    def switch_asics(self, available_power, active_power):
+        """
+        Enables or disables ASICs depending on available and active power
+
+        Parameters
+        ----------
+        available_power
+            A value of available power
+        active_power
+            A value of active power
+
+        Returns
+        -------
+        decision
+            A dict with the power group picked, IPs of enabled and disabled ASICs and active power after switching
+        """
+        decision = {
+            'power_group': None,
+            'enabled': [],
+            'disabled': [],
+            'active_power': active_power
+        }
+        enabled = []
+        disabled = []
+
+        # Checking available power against active power
+        if available_power >= active_power:
+            if self.ramp_up_in_progress():
+                # Waiting for the current power group to start up before picking the next one
+                enabled = self.process_ramp_up(available_power, active_power)
+            elif self.ramp_up['capped_at'] is not None and available_power <= self.ramp_up['capped_at']:
+                logging.info("Metered power has reached available power, waiting for more power")
             else:
-                # Fetching a power group with the attribute online='True'
-                power_group = self.get_random_power_group(online='True')
+                self.ramp_up['capped_at'] = None
 
-                for member in self.get_power_group_members(power_group.id):
-                    # Iterating through members of a power group to turn them off
-                    self.disable_asic(
-                        member.ip, member.port,
-                        member.user, member.password
-                    )
+                # Finishing a partially started power group if its offline members fit available power
+                power_group, members = self.get_partially_online_power_group(max_power=available_power - active_power)
 
-            # Sending stats to InfluxDB
-            self.write_logs(available_power, active_power)
+                if power_group is None:
+                    # Fetching the most efficient power group with the attribute online='False'
+                    candidate = self.get_power_group(online='False', max_power=available_power - active_power)
 
-            # Sleeping before the next iteration
-            time.sleep(self.sleep_timer)
+                    # Checking whether there's a power group available, and we have enough available power to turn it on
+                    if candidate is not None and available_power - active_power > candidate.total_power:
+                        power_group = candidate.id
+                        members = self.get_power_group_members(power_group)
+
+                if power_group is not None:
+                    # Queueing members of a power group to turn them on wave by wave
+                    decision['power_group'] = power_group
+                    self.ramp_up['pending'].extend(members)
+                    enabled = self.process_ramp_up(available_power, active_power)
+        else:
+            # Not enough power for ASICs which haven't been started yet
+            self.cancel_ramp_up()
+            self.ramp_up['capped_at'] = None
+
+            # Fetching the least efficient power group with the attribute online='True'
+            power_group = self.get_power_group(online='True')
+
+            if power_group is not None:
+                decision['power_group'] = power_group.id
+                disabled = self.get_power_group_members(power_group.id)
+
+            # Turning off members of a power group concurrently, so restarts take a single ASIC timeout
+            list(self.shutdown_executor.map(
+                lambda member: self.disable_asic(
+                    member.ip, member.port,
+                    member.user, member.password,
+                    member.type
+                ),
+                disabled
+            ))
+
+        decision['enabled'] = [member.ip for member in enabled]
+        decision['disabled'] = [member.ip for member in disabled]
+        decision['active_power'] += sum(member.power for member in enabled) - sum(member.power for member in disabled)
+
+        return decision
+
+    def ramp_up_in_progress(self):
+        """
+        Checks whether there are ASICs starting up or waiting to be started
+
+        Returns
+        -------
+        output
+            True if the ramp-up pipeline isn't empty
+        """
+        return len(self.ramp_up['wave']) > 0 or len(self.ramp_up['pending']) > 0
+
+    def process_ramp_up(self, available_power, active_power):
+        """
+        Advances the ramp-up pipeline
+        The next wave of ASICs is enabled only when the previous wave is mining or has timed out, and it's shrunk to
+        ASICs which fit available power. If none of them fit, the rest of the ramp-up is cancelled
+
+        Parameters
+        ----------
+        available_power
+            A value of available power
+        active_power
+            A value of active power (including ASICs which have already been enabled)
+
+        Returns
+        -------
+        wave
+            A list of enabled ASICs
+        """
+        if self.ramp_up['wave']:
+            readiness = self.get_next_step_readiness(self.ramp_up['wave'])
+            elapsed = time.time() - self.ramp_up['started']
+
+            if readiness['ready']:
+                logging.info(f"Ramp-up wave is mining after {round(elapsed)}s: {self.ramp_up['wave']}")
+                self.ramp_up['wave'] = []
+
+                # Stopping the ramp-up if metered power has already reached available power
+                if readiness['power'] > available_power:
+                    logging.warning(f"Metered power ({readiness['power']}) exceeds available power "
+                                    f"({available_power}), stopping ramp-up")
+                    self.cancel_ramp_up()
+                    self.ramp_up['capped_at'] = available_power
+                    return []
+            elif elapsed > self.ramp_wave_timeout:
+                logging.warning(f"Ramp-up wave timed out after {round(elapsed)}s "
+                                f"({readiness['mining_count']}/{readiness['active_count']} ASICs mining): "
+                                f"{self.ramp_up['wave']}")
+                self.ramp_up['wave'] = []
+            else:
+                # The wave is still starting up
+                return []
+
+        if not self.ramp_up['pending']:
+            return []
+
+        # Enabling the next wave of ASICs which fits available power
+        headroom = available_power - active_power
+        wave = []
+
+        while self.ramp_up['pending'] and len(wave) < self.ramp_wave_size:
+            member = self.ramp_up['pending'][0]
+
+            if headroom <= member.power:
+                break
+
+            self.ramp_up['pending'].popleft()
+            self.enable_asic(
+                member.ip, member.port,
+                member.user, member.password
+            )
+            headroom -= member.power
+            wave.append(member)
+
+        if not wave:
+            logging.warning(f"Not enough available power for the next ramp-up wave ({headroom}W left)")
+            self.cancel_ramp_up()
+            return []
+
+        self.ramp_up['wave'] = [member.ip for member in wave]
+        self.ramp_up['started'] = time.time()
+
+        return wave
+
+    def cancel_ramp_up(self):
+        """
+        Drops ASICs which are waiting to be enabled
+        """
+        if self.ramp_up_in_progress():
+            logging.info(f"Cancelling ramp-up, {len(self.ramp_up['pending'])} ASICs won't be started")
+
+        self.ramp_up['pending'].clear()
+        self.ramp_up['wave'] = []
+
+    def get_next_step_readiness(self, wave):
+        """
+        Checks whether all ASICs of a ramp-up wave are mining (report non-zero hashrate)
+
+        Parameters
+        ----------
+        wave
+            A list of IPs of ASICs in the wave
+
+        Returns
+        -------
+        readiness
+            A dict with 'ready' flag, metered 'power' (in Watts) and numbers of mining and active ASICs
+        """
+        readiness = {
+            'ready': False,
+            'power': 0,
+            'mining_count': 0,
+            'active_count': 0
+        }
+
+        try:
+            # ASICs of the wave are polled by API bypassing its cache, the request has its own part of switching budget
+            r = self.session.get(self.endpoints['GET']['readiness'], params={'ips': ','.join(wave)},
+                                 timeout=self.readiness_timeout)
+            data = r.json()
+
+            readiness['power'] = data['power']
+            readiness['mining_count'] = data['mining_count']
+            readiness['active_count'] = data['active_count']
+            readiness['ready'] = 0 < data['active_count'] <= data['mining_count']
+        except Exception as e:
+            logging.error(f"Error while fetching readiness: {e}")
+
+        return readiness
 
     def get_available_power(self):
         """
@@ -117,13 +472,13 @@ class AsicAgent:
         Returns
         -------
         available_power
-            A number representing available power (in Watts)
+            A number representing available power (in Watts), None if it couldn't be fetched
         """
         data = {}
 
         try:
             # Fetching and parsing a json file with available power
-            r = requests.get(self.endpoints['GET']['available_power'])
+            r = self.session.get(self.endpoints['GET']['available_power'], timeout=self.fetch_timeout)
             data = r.json()
         except Exception as e:
             logging.error(f"Download error {e}")
@@ -133,11 +488,26 @@ class AsicAgent:
             # If data was received successfully
             available_power = data['power']
         else:
-            # Default value
-            available_power = 0
+            # Power is unknown, ASICs are left as they are until POWER_STALE_TIMEOUT expires
+            available_power = None
 
         return available_power
 
+    def publish_state(self, state):
+        """
+        Sends the agent's state of the tick (power, decision, ramp-up, tick timings) to API
+
+        Parameters
+        ----------
+        state
+            The agent's state
+        """
+        try:
+            r = self.session.post(self.endpoints['UPDATE']['active_power'], json=state, timeout=self.logs_timeout)
+            r.raise_for_status()
+        except Exception as e:
+            logging.error(f"Error while publishing state: {e}")
+
     @orm.db_session
     def get_active_power(self):
         """
@@ -159,31 +529,110 @@ class AsicAgent:
         return active_power
 
     @orm.db_session
-    def get_random_power_group(self, online):
+    def get_power_group(self, online, max_power=None):
         """
-        Returns a random power group
+        Returns the most efficient power group to enable or the least efficient one to disable
+        Efficiency (TH/W) is based on hashrate of mining ASICs reported by API, ASICs which haven't mined yet
+        are assumed to be as efficient as the fleet on average.
+        When looking for a power group to enable, groups with fewer unreachable ASICs are preferred.
+        When looking for a power group to disable, unreachable ASICs count as 0 TH/s, so dead groups are shed first
 
         Parameters
         ----------
         online : str ('True' or 'False')
             The status of a power group
+        max_power
+            If set, only power groups with total power below this value are considered
 
         Returns
         -------
         output
             A power group data
         """
-        # Fetching a random power group
-        power_group = PowerGroups.select(lambda p: p.online == online).random(1)
+        # Fetching power groups meeting the criteria
+        power_groups = PowerGroups.select(lambda p: p.online == online)[:]
+
+        if max_power is not None:
+            power_groups = [power_group for power_group in power_groups if power_group.total_power < max_power]
 
         # Checking if there's a power group meeting the criteria
-        if len(power_group) > 0:
-            output = power_group[0]
-        else:
-            output = None
+        if len(power_groups) == 0:
+            return None
+
+        hosts = Hosts.select()[:]
+        hashrates = {efficiency.ip: efficiency.hashrate for efficiency in HostEfficiency.select()}
+        unreachable = self.health.get_unreachable()
+
+        # Calculating average efficiency of ASICs with known hashrate
+        known_power = sum(host.power for host in hosts if host.ip in hashrates)
+        average_efficiency = sum(hashrates[host.ip] for host in hosts if host.ip in hashrates) / known_power \
+            if known_power else 0
+
+        stats = {power_group.id: {'unreachable': 0, 'hashrate': 0.0, 'power': 0} for power_group in power_groups}
+
+        # Summing up hashrate, power and unreachable ASICs in each power group
+        for host in hosts:
+            if host.power_group not in stats:
+                continue
+
+            stats[host.power_group]['power'] += host.power
+
+            if host.ip in unreachable:
+                stats[host.power_group]['unreachable'] += 1
+
+                # An online ASIC which can't be reached isn't mining
+                if online == 'True':
+                    continue
+
+            stats[host.power_group]['hashrate'] += hashrates.get(host.ip, average_efficiency * host.power)
+
+        ranks = {}
+
+        for power_group_id, stat in stats.items():
+            efficiency = stat['hashrate'] / stat['power'] if stat['power'] else 0
+
+            # The lowest rank is picked
+            if online == 'False':
+                ranks[power_group_id] = (stat['unreachable'], -efficiency)
+            else:
+                ranks[power_group_id] = (efficiency, -stat['unreachable'])
+
+        # Picking a random power group among equally ranked ones
+        best = min(ranks.values())
+        output = random.choice([power_group for power_group in power_groups if ranks[power_group.id] == best])
 
         return output
 
+    @orm.db_session
+    def get_partially_online_power_group(self, max_power):
+        """
+        Returns a power group which has been started only partially (e.g. after a cancelled ramp-up or repartitioning)
+        and its offline members if their total power is below max_power
+
+        Parameters
+        ----------
+        max_power
+            Power available for the offline members
+
+        Returns
+        -------
+        output
+            A tuple of the power group id and a list of its offline members, (None, []) if there's no such group
+        """
+        online_groups = set(orm.select(h.power_group for h in Hosts if h.online == 'True'))
+        offline = {}
+
+        # Collecting offline members of power groups which are considered online
+        for host in Hosts.select(lambda p: p.online == 'False').order_by(Hosts.id):
+            if host.power_group in online_groups:
+                offline.setdefault(host.power_group, []).append(host)
+
+        for power_group, members in sorted(offline.items()):
+            if sum(member.power for member in members) < max_power:
+                return power_group, members
+
+        return None, []
+
     @orm.db_session
     def get_power_group_members(self, power_group):
         """
@@ -229,6 +678,10 @@ class AsicAgent:
             if power_group:
                 # If the power group exists, then update total_power
                 power_group.total_power += member.power
+
+                # A partially started power group (e.g. during ramp-up) is considered online
+                if member.online == 'True':
+                    power_group.online = 'True'
             else:
                 # If it doesn't exist, then create a new entry
                 power_group = PowerGroups(
@@ -277,7 +730,7 @@ class AsicAgent:
         # Changing status
         host.online = online
 
-    def disable_asic(self, ip, port, user, password):
+    def disable_asic(self, ip, port, user, password, asic_type):
         """
         Disables an ASIC
         It's achieved via disabling internet access and restarting CGMiner
@@ -292,13 +745,15 @@ class AsicAgent:
             ASIC's username
         password
             ASIC's password
+        asic_type
+            ASIC's type
         """
         logging.info(f"Shutting down ASIC: {ip}:{port}")
 
         # Updating ASIC's status in DB
         self.update_asic_status(ip, online='False')
         # Restarting CGMiner
-        self.restart_asic(ip, port, user, password)
+        self.restart_asic(ip, port, user, password, asic_type)
         # Disabling internet access
         self.disable_internet_access(ip)
 
@@ -335,15 +790,17 @@ class AsicAgent:
         """
         logging.info(f"Disabling internet access for: {ip}")
 
-        try:
-            # Connecting to Mikrotik's router
-            api = self.get_routeros_api()
+        with self.routeros_lock:
+            try:
+                # Connecting to Mikrotik's router
+                api = self.get_routeros_api()
 
-            # Adding IP to a blacklist (BL)
-            list_address = api.get_resource('/ip/firewall/address-list')
-            list_address.add(address=ip, list="BL")
-        except Exception as e:
-            logging.error(f"Error while disabling internet access for {ip}: {e}")
+                # Adding IP to a blacklist (BL)
+                list_address = api.get_resource('/ip/firewall/address-list')
+                list_address.add(address=ip, list="BL")
+            except Exception as e:
+                logging.error(f"Error while disabling internet access for {ip}: {e}")
+                self.close_routeros_api()
 
     def enable_internet_access(self, ip):
         """
@@ -356,16 +813,18 @@ class AsicAgent:
         """
         logging.info(f"Enabling internet access for: {ip}")
 
-        try:
-            # Connecting to Mikrotik's router
-            api = self.get_routeros_api()
+        with self.routeros_lock:
+            try:
+                # Connecting to Mikrotik's router
+                api = self.get_routeros_api()
 
-            # Removing IP from a blacklist (IP)
-            list_address = api.get_resource('/ip/firewall/address-list')
-            rule_id = list_address.detailed_get(address=ip)[0]['id']
-            list_address.remove(id=rule_id)
-        except Exception as e:
-            logging.error(f"Error while enabling internet access for {ip}: {e}")
+                # Removing IP from a blacklist (IP)
+                list_address = api.get_resource('/ip/firewall/address-list')
+                rule_id = list_address.detailed_get(address=ip)[0]['id']
+                list_address.remove(id=rule_id)
+            except Exception as e:
+                logging.error(f"Error while enabling internet access for {ip}: {e}")
+                self.close_routeros_api()
 
     def flush_access_rules(self):
         """
@@ -373,44 +832,63 @@ class AsicAgent:
         """
         logging.info("Flushing internet access rules")
 
-        try:
-            # Connecting to Mikrotik's router
-            api = self.get_routeros_api()
+        with self.routeros_lock:
+            try:
+                # Connecting to Mikrotik's router
+                api = self.get_routeros_api()
 
-            # Fetching all rules
-            list_address = api.get_resource('/ip/firewall/address-list')
-            rules = list_address.detailed_get()
+                # Fetching all rules
+                list_address = api.get_resource('/ip/firewall/address-list')
+                rules = list_address.detailed_get()
 
-            # Iterating through the list of rules
-            for rule in rules:
-                # Deleting a rule
-                list_address.remove(id=rule['id'])
-        except Exception as e:
-            logging.error(f"Error while flushing internet access rules: {e}")
+                # Iterating through the list of rules
+                for rule in rules:
+                    # Deleting a rule
+                    list_address.remove(id=rule['id'])
+            except Exception as e:
+                logging.error(f"Error while flushing internet access rules: {e}")
+                self.close_routeros_api()
 
     def get_routeros_api(self):
         """
-        Establishes a connecting with Mikrotik's router
+        Establishes a connecting with Mikrotik's router, the connection is kept for later calls
 
         Returns
         -------
         api
             Access to Mikrotik's API
         """
-        # Establishing connection with Mikrotik API
-        mk_connection = routeros_api.RouterOsApiPool(
-            self.router['ip'],
-            port=self.router['port'],
-            username=self.router['username'],
-            password=self.router['password'],
-            plaintext_login=True
-        )
-        mk_connection.set_timeout(self.mikrotik_access_timeout)
-        api = mk_connection.get_api()
+        if self.routeros is None:
+            # Importing RouterOS client only when the router is accessed
+            import routeros_api
+
+            # Establishing connection with Mikrotik API
+            mk_connection = routeros_api.RouterOsApiPool(
+                self.router['ip'],
+                port=self.router['port'],
+                username=self.router['username'],
+                password=self.router['password'],
+                plaintext_login=True
+            )
+            mk_connection.set_timeout(self.mikrotik_access_timeout)
+            mk_connection.get_api()
+            self.routeros = mk_connection
+
+        return self.routeros.get_api()
+
+    def close_routeros_api(self):
+        """
+        Closes the connection with Mikrotik's router, so the next call reconnects (e.g. after an error)
+        """
+        if self.routeros is not None:
+            try:
+                self.routeros.disconnect()
+            except Exception as e:
+                logging.error(f"Error while disconnecting from the router: {e}")
 
-        return api
+            self.routeros = None
 
-    def restart_asic(self, ip, port, user, password):
+    def restart_asic(self, ip, port, user, password, asic_type):
         """
         Restarts CGMiner process
 
@@ -424,19 +902,26 @@ class AsicAgent:
             ASIC's username
         password
             ASIC's password
+        asic_type
+            ASIC's type, selects a driver for ASIC's API
         """
         logging.info(f"Restarting ASIC: {ip}:{port}")
 
+        # Skipping ASICs which are known to be unreachable
+        timeout = self.health.get_timeout(ip)
+
+        if timeout is None:
+            logging.info(f"Skipping restart of unreachable ASIC: {ip}")
+            return
+
         try:
-            # Connecting to ASIC via API
-            api = DragonAPI(f"{ip}:{port}",
-                            username=user,
-                            password=password,
-                            timeout=self.reset_asic_timeout)
-
-            # Restarting CGMiner
-            api.restartCgMiner()
+            started = time.monotonic()
+
+            # Restarting CGMiner with a driver for the ASIC's type
+            get_driver(asic_type).restart(f"{ip}:{port}", user, password, timeout)
+            self.health.record_success(ip, time.monotonic() - started)
         except Exception as e:
+            self.health.record_failure(ip)
             logging.error(f"Error occurred during restarting an ASIC ({ip}): {e}")
 
     @orm.db_session
@@ -468,7 +953,7 @@ class AsicAgent:
     @orm.db_session
     def write_logs(self, available_power, active_power):
         """
-        Sends values of available and active power to InfluxDB
+        Sends values of available and active power to the metrics sink
 
         Parameters
         ----------
@@ -478,21 +963,27 @@ class AsicAgent:
             A value of active power
         """
         try:
-            # Fetching InfluxDB write API
-            write_api = self.influxdb_write_api
-
-            # Creating a measurement for available power
-            p = Point("power").tag("type", "available").field("power", available_power)
-            write_api.write(bucket=self.influxdb['bucket'], org=self.influxdb['org'], record=p)
-
-            # Creating a measurement for active power
-            p = Point("power").tag("type", "active").field("power", active_power)
-            write_api.write(bucket=self.influxdb['bucket'], org=self.influxdb['org'], record=p)
+            records = [
+                # Creating a measurement for available power
+                {'measurement': 'power', 'tags': {'type': 'available'}, 'fields': {'power': available_power}},
+                # Creating a measurement for active power
+                {'measurement': 'power', 'tags': {'type': 'active'}, 'fields': {'power': active_power}}
+            ]
+
+            # Creating a measurement for tick drift and durations of tick steps
+            if self.tick_stats:
+                records.append({
+                    'measurement': 'tick',
+                    'tags': {},
+                    'fields': {name: float(value) for name, value in self.tick_stats.items()}
+                })
 
             for host in self.show_status():
                 online = 1 if host.online == 'True' else 0
-                p = Point("power").tag("type", host.ip).field("online", online)
-                write_api.write(bucket=self.influxdb['bucket'], org=self.influxdb['org'], record=p)
+                records.append({'measurement': 'power', 'tags': {'type': host.ip}, 'fields': {'online': online}})
+
+            # Sending all measurements in one batch
+            self.metrics.write(records)
         except Exception as e:
             logging.error(f"Error writing logs: {e}")
 
@@ -503,7 +994,19 @@ if __name__ == '__main__':
     # Timeout for accessing ASIC
     RESET_ASIC_TIMEOUT = 5
     # Timeout for accessing Mikrotik router
-    MIKROTIK_ACCESS_TIMEOUT = 5
+    MIKROTIK_ACCESS_TIMEOUT = 3
+    # Number of ASICs enabled at once during ramp-up
+    RAMP_WAVE_SIZE = 4
+    # Time to wait for a ramp-up wave to start mining (in seconds)
+    RAMP_WAVE_TIMEOUT = 300
+    # Time budget for fetching available power and reading DB (in seconds)
+    FETCH_TIMEOUT = 3
+    # Timeout for checking whether a ramp-up wave is mining
+    READINESS_TIMEOUT = 3
+    # Time budget for sending stats to the metrics sink (in seconds)
+    LOGS_TIMEOUT = 3
+    # Time after which ASICs are shed if available power can't be fetched (in seconds)
+    POWER_STALE_TIMEOUT = 60
     # URL for getting active power updates
     URL = "http://127.0.0.1:8000"
     # Router credentials
@@ -513,6 +1016,10 @@ if __name__ == '__main__':
         'username': 'admin',
         'password': 'aszpvo'
     }
+    # Metrics sink (influxdb / file / none)
+    METRICS_SINK = 'influxdb'
+    # File for metrics (for file sink)
+    METRICS_FILE = 'metrics.ndjson'
     # InfluxDB credentials
     INFLUXDB = {
         'scheme': 'http',
@@ -553,5 +1060,20 @@ if __name__ == '__main__':
         total_power = orm.Required(int)
         online = orm.Required(str)
 
+    # Defining a table for ASICs health (shared with API)
+    class HostHealth(db.Entity):
+        ip = orm.PrimaryKey(str)
+        failures = orm.Required(int)
+        last_success = orm.Optional(float)
+        last_failure = orm.Optional(float)
+        latency = orm.Optional(float)
+        next_probe = orm.Required(float)
+
+    # Defining a table for ASICs hashrate while mining (shared with API)
+    class HostEfficiency(db.Entity):
+        ip = orm.PrimaryKey(str)
+        hashrate = orm.Required(float)
+        updated = orm.Required(float)
+
     # Starting main loop
     AsicAgent().run()
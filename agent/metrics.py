@@ -0,0 +1,112 @@
+"""
+Metrics sinks of ASIC-agent, a sink is selected with METRICS_SINK (influxdb / file / none)
+Client libraries are imported only when their sink is used
+"""
+import json
+import time
+
+
+class InfluxDBSink:
+    """
+    Writes metrics to InfluxDB
+    """
+    def __init__(self, scheme, host, port, token, org, bucket):
+        from influxdb_client import InfluxDBClient, Point
+
+        self.point = Point
+        self.org = org
+        self.bucket = bucket
+
+        # Establishing connection with InfluxDB
+        self.client = InfluxDBClient(
+            url=f"{scheme}://{host}:{port}",
+            token=token,
+            org=org
+        )
+        # InfluxDB write API
+        self.write_api = self.client.write_api()
+
+    def write(self, records):
+        """
+        Writes a batch of records
+
+        Parameters
+        ----------
+        records
+            A list of dicts with measurement, tags and fields
+        """
+        points = []
+
+        for record in records:
+            point = self.point(record['measurement'])
+
+            for key, value in record['tags'].items():
+                point = point.tag(key, value)
+
+            for key, value in record['fields'].items():
+                point = point.field(key, value)
+
+            points.append(point)
+
+        self.write_api.write(bucket=self.bucket, org=self.org, record=points)
+
+
+class FileSink:
+    """
+    Appends metrics to a local file, one JSON record per line (NDJSON)
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        """
+        Writes a batch of records
+
+        Parameters
+        ----------
+        records
+            A list of dicts with measurement, tags and fields
+        """
+        now = time.time()
+
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(dict(record, time=now)) + '\n')
+
+
+class NullSink:
+    """
+    Discards metrics
+    """
+    def write(self, records):
+        pass
+
+
+def get_metrics_sink(name, influxdb=None, path=None):
+    """
+    Creates a metrics sink
+
+    Parameters
+    ----------
+    name
+        A name of the sink (influxdb / file / none)
+    influxdb
+        InfluxDB credentials (for influxdb sink)
+    path
+        A path of the file (for file sink)
+
+    Returns
+    -------
+    sink
+        A metrics sink
+    """
+    if name == 'influxdb':
+        return InfluxDBSink(**influxdb)
+
+    if name == 'file':
+        return FileSink(path)
+
+    if name == 'none':
+        return NullSink()
+
+    raise ValueError(f"Unknown metrics sink: {name}")
@@ -1,19 +1,57 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from datetime import datetime
 from pony import orm
+import os
+import time
+import logging
+import asyncio
 import uvicorn
-from dragon_rest.dragons import DragonAPI
+from miners import get_driver, invalidate_dragon_client
+from health import HostHealthTracker
 from concurrent.futures import ThreadPoolExecutor
-from cachetools import cached, TTLCache
+from cachetools import TTLCache
 import json
+import struct
+import threading
 
 app = FastAPI()
 
-app.state.available_power = 0
-app.state.monitoring = {}
-app.state.relay_state = {}
+# Timeout for accessing ASIC
+ASIC_ACCESS_TIMEOUT = 5
+# Smoothing factor of ASIC's hashrate average
+HASHRATE_ALPHA = 0.3
+# Time for which responses of ASICs are cached (in seconds)
+ASICS_INFO_TTL = 60
+# Time after which the state reported by ASIC-agent is considered outdated (in seconds)
+AGENT_STATE_TTL = 60
+# Interval between checks for changes of shared state (in seconds)
+STATE_POLL_INTERVAL = 0.5
+# Number of monitoring samples kept in history (a day of samples taken every second)
+MONITORING_HISTORY_SIZE = 86400
+# Binary encoding of a monitoring sample: time (Unix timestamp), power of phases A, B, C (in kW)
+MONITORING_SAMPLE_FORMAT = '<dfff'
+# Interval between checks for fleet changes sent to event streams (in seconds)
+EVENTS_INTERVAL = 5
+# Number of recent events kept for resuming event streams
+EVENTS_LOG_SIZE = 1000
+# Number of events queued for a client, a slower client is sent a new snapshot instead
+EVENTS_QUEUE_SIZE = 100
+# Interval between keep-alive messages of event streams (in seconds)
+EVENTS_KEEPALIVE = 15
+# Time to wait for the first fleet snapshot before an event stream is closed with an error (in seconds)
+EVENTS_READY_TIMEOUT = 10
+# Time after which another worker takes over checking fleet state if its producer stops renewing the lease (in seconds)
+EVENTS_LEASE_TIMEOUT = 20
+# Minimal change of ASIC's hashrate sent to event streams (in TH/s)
+HASHRATE_CHANGE_THRESHOLD = 1.0
+# Minimal change of ASIC's temperature sent to event streams
+TEMPERATURE_CHANGE_THRESHOLD = 2.0
+
+# Cached responses of ASICs by ASIC id
+asics_info_cache = TTLCache(maxsize=1024, ttl=ASICS_INFO_TTL)
+asics_info_lock = threading.Lock()
 
 app.add_middleware(
     CORSMiddleware,
@@ -49,7 +87,60 @@ class PowerGroups(db.Entity):
     online = orm.Required(str)
 
 
-db.generate_mapping()
+# Defining a table for ASICs health (shared with ASIC-agent)
+class HostHealth(db.Entity):
+    ip = orm.PrimaryKey(str)
+    failures = orm.Required(int)
+    last_success = orm.Optional(float)
+    last_failure = orm.Optional(float)
+    latency = orm.Optional(float)
+    next_probe = orm.Required(float)
+
+
+# Defining a table for ASICs hashrate while mining (shared with ASIC-agent)
+class HostEfficiency(db.Entity):
+    ip = orm.PrimaryKey(str)
+    hashrate = orm.Required(float)
+    updated = orm.Required(float)
+
+
+# Defining a table for API state shared between worker processes
+class State(db.Entity):
+    key = orm.PrimaryKey(str)
+    value = orm.Optional(orm.Json)
+    version = orm.Required(int)
+
+
+# Defining a table for history of monitoring samples (a ring buffer of MONITORING_HISTORY_SIZE slots)
+class MonitoringSamples(db.Entity):
+    slot = orm.PrimaryKey(int)
+    seq = orm.Required(int, index=True)
+    time = orm.Required(float, index=True)
+    value = orm.Optional(orm.Json)
+
+
+# Defining a table for fleet state of event streams (a single row shared between worker processes): the state as it
+# has been sent to clients, the last event id and the worker holding the lease for checking fleet state
+class FleetState(db.Entity):
+    id = orm.PrimaryKey(int)
+    epoch = orm.Required(str)
+    seq = orm.Required(int)
+    value = orm.Optional(orm.Json)
+    producer = orm.Optional(str)
+    lease = orm.Required(float)
+
+
+# Defining a table for recent fleet events (the last EVENTS_LOG_SIZE events are kept for resuming event streams)
+class FleetEventLog(db.Entity):
+    seq = orm.PrimaryKey(int)
+    event = orm.Required(str)
+    data = orm.Optional(orm.Json)
+
+
+db.generate_mapping(create_tables=True)
+
+# Tracking health of ASICs, HEALTH_* settings are read by the tracker
+health_tracker = HostHealthTracker(HostHealth, ASIC_ACCESS_TIMEOUT)
 
 
 @app.get("/get_power", description="Returns available power (in Watts) for ASICs")
@@ -57,13 +148,13 @@ async def get_power():
     return {
         'success': True,
         'time': datetime.now(),
-        'power': app.state.available_power
+        'power': get_state('available_power', 0)
     }
 
 
 @app.post("/set_power/{power}", description="Sets available power (in Watts) for ASIC-agent")
 async def set_power(power: int):
-    app.state.available_power = power
+    set_state('available_power', power)
 
     return {'success': True}
 
@@ -112,6 +203,9 @@ async def update_asic(request: Request):
             return {'success': 'true', 'status': 'created'}
         # Updating existing entry
         else:
+            # Dropping a connection made with old address and credentials
+            invalidate_dragon_client(f"{host.ip}:{host.port}")
+
             host.ip = data['ip']
             host.port = data['port']
             host.user = data['user']
@@ -132,11 +226,50 @@ async def delete_asic(asic_id: int):
         if not host:
             return {'detail': 'Not Found'}
         else:
+            invalidate_dragon_client(f"{host.ip}:{host.port}")
             host.delete()
 
             return {'success': 'true', 'status': 'updated'}
 
 
+@app.post("/partition_power_groups", description="Proposes (and optionally applies) power groups of mixed sizes "
+                                                "so that available power can be matched with a small error")
+async def partition_power_groups(request: Request):
+    data = await request.json()
+
+    with orm.db_session:
+        hosts = [(host.id, host.power, host.phase) for host in Hosts.select()]
+
+    if not hosts:
+        return {'success': False, 'error': 'There are no ASICs'}
+
+    # Choosing granularity: explicit value or typical step of a power trace, but not below the smallest ASIC
+    if data.get('granularity'):
+        granularity = int(data['granularity'])
+    elif data.get('trace'):
+        granularity = get_trace_granularity(data['trace'])
+    else:
+        granularity = 0
+
+    granularity = max(granularity, min(power for _, power, _ in hosts), 1)
+    power_groups = propose_power_groups(hosts, granularity, data.get('max_group_size'))
+
+    # Assigning ASICs to new power groups in one transaction
+    if data.get('apply'):
+        with orm.db_session:
+            for power_group in power_groups:
+                for host_id in power_group['hosts']:
+                    Hosts[host_id].power_group = power_group['id']
+
+    return {
+        'success': True,
+        'granularity': granularity,
+        'max_error': get_max_power_error([power_group['total_power'] for power_group in power_groups]),
+        'applied': bool(data.get('apply')),
+        'power_groups': power_groups
+    }
+
+
 @app.get("/asic_status", description="Returns info about all ASICS from DB (credentials, status)")
 async def asic_status():
     with orm.db_session:
@@ -159,8 +292,37 @@ async def asic_status():
     return output
 
 
-@app.get("/get_active_power", description="Returns power (in Watts) used by all ASICs (calculated value)")
+@app.post("/set_active_power", description="Updates the state of ASIC-agent's last tick (active power, decision, "
+                                          "tick timings)")
+async def set_active_power(request: Request):
+    data = await request.json()
+    set_state('agent', data)
+
+    return {
+        'success': True,
+        'time': datetime.now(),
+    }
+
+
+@app.get("/decisions", description="Returns the state of ASIC-agent's last tick (available and active power, "
+                                   "power group enabled/disabled, ramp-up, tick timings)")
+async def decisions():
+    return get_state('agent', {})
+
+
+@app.get("/get_active_power", description="Returns power (in Watts) used by all ASICs (reported by ASIC-agent "
+                                          "or calculated value)")
 async def get_active_power():
+    agent = get_state('agent', {})
+
+    # Using the value reported by ASIC-agent unless it's outdated
+    if 'active_power' in agent and time.time() - agent.get('time', 0) < AGENT_STATE_TTL:
+        return {
+            'success': True,
+            'time': datetime.fromtimestamp(agent['time']),
+            'power': agent['active_power']
+        }
+
     with orm.db_session:
         hosts = Hosts.select()
         power = 0
@@ -176,28 +338,77 @@ async def get_active_power():
 
 
 @app.get("/get_asic_info/{asic_id}", include_in_schema=False, description="Returns an info about an ASIC from API")
-@cached(cache=TTLCache(maxsize=1024, ttl=60))
 def get_asic_info(asic_id: int):
+    return asyncio.run(poll_asics([asic_id]))[0]
+
+
+@app.get("/asic_health", description="Returns health of all ASICs (failures, last success, latency)")
+async def asic_health():
     with orm.db_session:
-        host = Hosts.get(id=asic_id)
+        hosts = Hosts.select()
+        output = []
 
-    if not host:
-        return {'detail': 'Not Found'}
+        for host in hosts:
+            health = HostHealth.get(ip=host.ip)
+            status = health_tracker.get_status(health)
 
-    try:
-        # Connecting to ASIC via API
-        api = DragonAPI(f"{host.ip}:{host.port}",
-                        username=host.user, password=host.password,
-                        timeout=5)
+            output.append(
+                {
+                    'id': host.id,
+                    'ip': host.ip,
+                    'status': status,
+                    'failures': health.failures if health else 0,
+                    'last_success': health.last_success if health else None,
+                    'last_failure': health.last_failure if health else None,
+                    'latency': health.latency if health else None,
+                    'next_probe': health.next_probe if health and health.next_probe else None
+                }
+            )
 
-        r = api.summary()
-    except Exception:
-        r = {'success': False, 'error': 'Cannot connect to the ASIC'}
+    return output
 
-    # Adding ASIC id to response
-    r['id'] = asic_id
 
-    return r
+@app.get("/asic_efficiency", description="Returns efficiency (TH/W) of ASICs and power groups "
+                                         "based on hashrate while mining")
+async def asic_efficiency():
+    with orm.db_session:
+        hosts = Hosts.select()
+        hashrates = {efficiency.ip: efficiency.hashrate for efficiency in HostEfficiency.select()}
+        asics = []
+        power_groups = {}
+
+        for host in hosts:
+            hashrate = hashrates.get(host.ip)
+
+            asics.append(
+                {
+                    'id': host.id,
+                    'ip': host.ip,
+                    'power_group': host.power_group,
+                    'hashrate': hashrate,
+                    'efficiency': hashrate / host.power if hashrate is not None and host.power else None
+                }
+            )
+
+            # Summing up ASICs with known hashrate in each power group
+            power_group = power_groups.setdefault(host.power_group, {'hashrate': 0.0, 'power': 0})
+
+            if hashrate is not None:
+                power_group['hashrate'] += hashrate
+                power_group['power'] += host.power
+
+    return {
+        'asics': sorted(asics, key=lambda x: x['efficiency'] or 0, reverse=True),
+        'power_groups': sorted(
+            [
+                {
+                    'id': power_group_id,
+                    'efficiency': power_group['hashrate'] / power_group['power'] if power_group['power'] else None
+                } for power_group_id, power_group in power_groups.items()
+            ],
+            key=lambda x: x['efficiency'] or 0, reverse=True
+        )
+    }
 
 
 @app.get("/asics_info", include_in_schema=False, description="Returns info about all ASICS from API")
@@ -262,7 +473,11 @@ def get_power_by_hashrate():
 @app.post("/monitoring", description="Updates info about container monitoring (temp, voltage, etc)")
 async def update_monitoring(request: Request):
     data = await request.json()
-    app.state.monitoring = data
+
+    if not isinstance(data, dict):
+        return {'success': False, 'error': 'Monitoring info must be a JSON object'}
+
+    store_monitoring_samples([dict(data, time=time.time())])
 
     return {
         'success': True,
@@ -272,13 +487,77 @@ async def update_monitoring(request: Request):
 
 @app.get("/monitoring", description="Returns info about container monitoring")
 async def get_monitoring():
-    return app.state.monitoring
+    return get_state('monitoring', {})
+
+
+@app.post("/monitoring/samples", description="Adds a batch of timestamped monitoring samples: a JSON array of "
+                                             "samples with 'time' (Unix timestamp) or binary records "
+                                             "(application/octet-stream) of time and power of phases A, B, C (in kW)")
+async def add_monitoring_samples(request: Request):
+    if request.headers.get('content-type') == 'application/octet-stream':
+        body = await request.body()
+        size = struct.calcsize(MONITORING_SAMPLE_FORMAT)
+
+        if len(body) % size:
+            return {'success': False, 'error': f'Body size must be a multiple of {size} bytes'}
+
+        samples = [
+            {'time': t, 'meter': {'power': {'A': a, 'B': b, 'C': c}}}
+            for t, a, b, c in struct.iter_unpack(MONITORING_SAMPLE_FORMAT, body)
+        ]
+    else:
+        samples = await request.json()
+
+        if not isinstance(samples, list) or not all(isinstance(sample, dict) for sample in samples):
+            return {'success': False, 'error': 'Samples must be a JSON array of objects'}
+
+    if not samples:
+        return {'success': False, 'error': 'No samples'}
+
+    for sample in samples:
+        sample.setdefault('time', time.time())
+
+        if not isinstance(sample['time'], (int, float)) or isinstance(sample['time'], bool):
+            return {'success': False, 'error': "Sample's time must be a Unix timestamp"}
+
+    store_monitoring_samples(samples)
+
+    return {
+        'success': True,
+        'time': datetime.now(),
+        'samples': len(samples)
+    }
+
+
+@app.get("/monitoring/history", description="Returns monitoring samples between start and end (Unix timestamps, "
+                                            "the last hour by default) averaged over step seconds (0 for raw samples)")
+def get_monitoring_history(start: float = None, end: float = None, step: float = 0):
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 3600
+
+    with orm.db_session:
+        samples = orm.select(
+            (s.time, s.value) for s in MonitoringSamples if s.time >= start and s.time <= end
+        ).order_by(1)[:]
+
+    samples = [dict(value, time=sample_time) for sample_time, value in samples]
+
+    if step <= 0:
+        return samples
+
+    # Averaging samples in buckets of step seconds
+    buckets = {}
+
+    for sample in samples:
+        buckets.setdefault(int((sample['time'] - start) // step), []).append(sample)
+
+    return [average_samples(buckets[bucket]) for bucket in sorted(buckets)]
 
 
 @app.post("/relay_state", description="Updates info about relay state")
 async def update_relay_state(request: Request):
     data = await request.json()
-    app.state.relay_state = data
+    set_state('relay_state', data)
 
     return {
         'success': True,
@@ -288,22 +567,39 @@ async def update_relay_state(request: Request):
 
 @app.get("/relay_state", description="Returns info about relay state")
 async def get_relay_state():
-    return app.state.relay_state
+    return get_state('relay_state', {})
+
+
+@app.get("/state_changes", description="Waits up to timeout (in seconds) for changes of available power, "
+                                       "monitoring or relay state after the given version and returns them")
+async def state_changes(since: int = 0, timeout: float = 0):
+    version = await wait_for_state_change(since, min(timeout, 60))
+
+    return {
+        'version': version,
+        'changes': get_state_changes(since)
+    }
+
+
+@app.get("/events", description="Streams fleet changes (server-sent events): a snapshot followed by changes of "
+                                "ASICs and available power, reconnecting clients resume after Last-Event-ID. "
+                                "The stream is closed with an 'unavailable' event if fleet state can't be read")
+async def events(request: Request, last_event_id: str = None):
+    last_event_id = request.headers.get('last-event-id') or last_event_id
+
+    return StreamingResponse(fleet_events.stream(last_event_id), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.get("/running_asics", description="Returns a number of running (mining) ASICs")
 async def running_asics():
     # Fetching data from ASICS
-    fields = json.loads(fetch_asics_info())
+    fields = json.loads(await asyncio.to_thread(fetch_asics_info))
     count = 0
 
     # Iterating through ASICs
     for field in fields:
-        # Checking if there's a response from ASIC
-        if 'success' not in field or field['success'] is False:
-            continue
-
-        if 'TotalHash' in field and field['TotalHash']['Unit'] == 'TH/s':
+        if is_mining(field):
             count += 1
 
     return {
@@ -313,35 +609,40 @@ async def running_asics():
 
 
 @app.get("/next_step_readiness", description="Returns active power (in Watts) when ASICs "
-                                             "for the current step has started or 0 if they're starting up")
-async def next_step_readiness():
-    # Fetching data from ASICS
-    fields = json.loads(fetch_asics_info())
-    mining_count = 0
-
-    # Iterating through ASICs
-    for field in fields:
-        # Checking if there's a response from ASIC
-        if 'success' not in field or field['success'] is False:
-            continue
+                                             "for the current step has started or 0 if they're starting up. "
+                                             "If ips (comma-separated) are given, only these ASICs are checked "
+                                             "with fresh data")
+async def next_step_readiness(ips: str = None):
+    if ips:
+        # Polling ASICs of the current step bypassing the cache, they count as active
+        with orm.db_session:
+            ids = [host.id for host in Hosts.select() if host.ip in ips.split(',')]
+
+        fields = await asyncio.to_thread(asyncio.run, poll_asics(ids, use_cache=False))
+        active_count = len(ids)
+    else:
+        # Fetching data from ASICS
+        fields = json.loads(await asyncio.to_thread(fetch_asics_info))
+        active_count = 0
 
-        if 'TotalHash' in field and field['TotalHash']['Unit'] == 'TH/s':
-            mining_count += 1
+        # Iterating through ASICs
+        for field in await asic_status():
+            if 'online' in field and field['online'] == 'True':
+                active_count += 1
 
-    # Fetching data from a table of
-    fields = await asic_status()
-    active_count = 0
+    mining_count = 0
 
     # Iterating through ASICs
     for field in fields:
-        if 'online' in field and field['online'] == 'True':
-            active_count += 1
+        if is_mining(field):
+            mining_count += 1
 
     if mining_count < active_count or mining_count == 0:
         power = 0
     else:
-        power = 1000 * (app.state.monitoring['meter']['power']['A'] + app.state.monitoring['meter']['power']['B'] +
-                        app.state.monitoring['meter']['power']['C'])
+        # Metered power is 0 until the first monitoring update is received
+        meter = get_state('monitoring', {}).get('meter', {}).get('power', {})
+        power = 1000 * (meter.get('A', 0) + meter.get('B', 0) + meter.get('C', 0))
 
     return {
         "power": power,
@@ -350,24 +651,633 @@ async def next_step_readiness():
     }
 
 
+def is_mining(field):
+    """
+    Checks whether an ASIC's response reports non-zero hashrate
+    """
+    # Checking if there's a response from ASIC
+    if 'success' not in field or field['success'] is False:
+        return False
+
+    return 'TotalHash' in field and field['TotalHash']['Unit'] == 'TH/s' and field['TotalHash']['Hash Rate'] > 0
+
+
+def record_host_hashrate(ip, summary):
+    """
+    Updates ASIC's hashrate average from its summary, only samples of a mining ASIC are taken into account
+    """
+    if 'TotalHash' not in summary or summary['TotalHash']['Unit'] != 'TH/s':
+        return
+
+    hashrate = summary['TotalHash']['Hash Rate']
+
+    if hashrate <= 0:
+        return
+
+    with orm.db_session:
+        efficiency = HostEfficiency.get(ip=ip)
+
+        if not efficiency:
+            HostEfficiency(ip=ip, hashrate=hashrate, updated=time.time())
+        else:
+            efficiency.hashrate = HASHRATE_ALPHA * hashrate + (1 - HASHRATE_ALPHA) * efficiency.hashrate
+            efficiency.updated = time.time()
+
+
+def get_state(key, default=None):
+    """
+    Returns a value of state shared between worker processes
+    """
+    with orm.db_session:
+        state = State.get(key=key)
+
+        return state.value if state else default
+
+
+def set_state(key, value):
+    """
+    Sets a value of state shared between worker processes
+    Every update gets the next version number, so other workers can find out what has changed
+    """
+    # Locking DB for writing to get a unique version number
+    with orm.db_session(serializable=True):
+        return update_state(key, value)
+
+
+def update_state(key, value):
+    """
+    Sets a value of shared state within a serializable db_session opened by the caller
+    """
+    version = (orm.max(s.version for s in State) or 0) + 1
+    state = State.get(key=key)
+
+    if state:
+        state.value = value
+        state.version = version
+    else:
+        State(key=key, value=value, version=version)
+
+    return version
+
+
+def get_state_changes(since):
+    """
+    Returns values of shared state updated after the given version
+    """
+    with orm.db_session:
+        return {state.key: state.value for state in State.select(lambda s: s.version > since)}
+
+
+async def wait_for_state_change(since, timeout, keys=None):
+    """
+    Waits until shared state (or only the given keys) is updated after the given version or timeout expires,
+    returns the latest version
+    """
+    deadline = time.monotonic() + timeout
+
+    while True:
+        with orm.db_session:
+            if keys is None:
+                version = orm.max(s.version for s in State) or 0
+            else:
+                version = orm.max(s.version for s in State if s.key in keys) or 0
+
+        if version > since or time.monotonic() >= deadline:
+            return version
+
+        await asyncio.sleep(STATE_POLL_INTERVAL)
+
+
+def store_monitoring_samples(samples):
+    """
+    Appends monitoring samples to the history, the oldest samples are overwritten
+    The newest sample becomes the current monitoring info unless a later one has already been stored
+    """
+    # Locking DB for writing to get unique slots
+    with orm.db_session(serializable=True):
+        # Replacing the current monitoring info only with a later sample (batches may arrive out of order)
+        newest = max(samples, key=lambda x: x['time'])
+        current = State.get(key='monitoring')
+        current_time = current.value.get('time') if current and isinstance(current.value, dict) else None
+
+        if current_time is None or current_time < newest['time']:
+            update_state('monitoring', newest)
+
+        seq = orm.max(s.seq for s in MonitoringSamples)
+        seq = seq + 1 if seq is not None else 0
+
+        for sample in samples:
+            slot = seq % MONITORING_HISTORY_SIZE
+            entry = MonitoringSamples.get(slot=slot)
+
+            if entry:
+                entry.seq = seq
+                entry.time = sample['time']
+                entry.value = sample
+            else:
+                MonitoringSamples(slot=slot, seq=seq, time=sample['time'], value=sample)
+
+            seq += 1
+
+
+def average_samples(samples):
+    """
+    Averages numbers of monitoring samples (including nested ones), other values are taken from the last sample
+    """
+    output = {}
+
+    for key, value in samples[-1].items():
+        values = [sample[key] for sample in samples if key in sample]
+
+        if all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in values):
+            output[key] = sum(values) / len(values)
+        elif all(isinstance(x, dict) for x in values):
+            output[key] = average_samples(values)
+        else:
+            output[key] = value
+
+    return output
+
+
+def get_trace_granularity(trace):
+    """
+    Returns a typical step (in Watts) of a historical trace of available power
+    """
+    steps = sorted(abs(b - a) for a, b in zip(trace, trace[1:]) if b != a)
+
+    if not steps:
+        return 0
+
+    # Median change of available power
+    return int(steps[len(steps) // 2])
+
+
+def propose_power_groups(hosts, granularity, max_group_size=None):
+    """
+    Splits ASICs into power groups of mixed sizes (granularity, granularity, 2 * granularity, 4 * granularity, ...)
+    so that any sum of power up to the total can be matched within about granularity
+    Groups are formed within a phase, max_group_size limits a number of ASICs in a group
+    (a number of router rules changed at once)
+
+    Parameters
+    ----------
+    hosts
+        A list of tuples (id, power, phase)
+    granularity
+        A size (in Watts) of the smallest power groups
+    max_group_size
+        A maximum number of ASICs in a group
+    """
+    power_groups = []
+
+    for phase in sorted({phase for _, _, phase in hosts}):
+        members = sorted([host for host in hosts if host[2] == phase], key=lambda x: x[1], reverse=True)
+        total_power = sum(power for _, power, _ in members)
+
+        # Target sizes: every next group is as big as all previous ones, the rest goes to the last group
+        targets = [granularity]
+
+        while 2 * sum(targets) <= total_power:
+            targets.append(sum(targets))
+
+        if total_power > sum(targets):
+            targets.append(total_power - sum(targets))
+
+        bins = [{'target': target, 'power': 0, 'hosts': []} for target in targets]
+
+        # Putting the most powerful ASICs first into a group where they fit best (or with the most room left)
+        for host_id, power, _ in members:
+            candidates = [b for b in bins if not max_group_size or len(b['hosts']) < max_group_size]
+            fitting = [b for b in candidates if b['target'] - b['power'] >= power]
+
+            if fitting:
+                b = min(fitting, key=lambda x: x['target'] - x['power'])
+            elif candidates:
+                b = max(candidates, key=lambda x: x['target'] - x['power'])
+            else:
+                b = {'target': power, 'power': 0, 'hosts': []}
+                bins.append(b)
+
+            b['power'] += power
+            b['hosts'].append(host_id)
+
+        for b in bins:
+            if b['hosts']:
+                power_groups.append({'phase': phase, 'total_power': b['power'], 'hosts': b['hosts']})
+
+    # Numbering power groups from the smallest to the biggest
+    power_groups.sort(key=lambda x: x['total_power'])
+
+    for power_group_id, power_group in enumerate(power_groups, start=1):
+        power_group['id'] = power_group_id
+
+    return power_groups
+
+
+def get_max_power_error(powers):
+    """
+    Returns the biggest step (in Watts) between total powers of combinations of groups,
+    i.e. the worst case of unused available power
+    """
+    # Bit N is set if there's a combination of groups with total power of N Watts
+    sums = 1
+
+    for power in powers:
+        sums |= sums << power
+
+    bits = bin(sums)[:1:-1]
+    reachable = [power for power, bit in enumerate(bits) if bit == '1']
+
+    return max(b - a for a, b in zip(reachable, reachable[1:])) if len(reachable) > 1 else 0
+
+
+async def query_asic(asic_id, use_cache=True):
+    """
+    Returns an info about an ASIC from its API, responses are cached for ASICS_INFO_TTL seconds
+    """
+    with asics_info_lock:
+        if use_cache and asic_id in asics_info_cache:
+            return asics_info_cache[asic_id]
+
+    with orm.db_session:
+        host = Hosts.get(id=asic_id)
+
+    if not host:
+        return {'detail': 'Not Found'}
+
+    # Skipping ASICs which are known to be unreachable
+    timeout = health_tracker.get_timeout(host.ip)
+
+    if timeout is None:
+        r = {'success': False, 'error': 'ASIC is unreachable'}
+    else:
+        try:
+            started = time.monotonic()
+
+            # Fetching a summary with a driver for the ASIC's type
+            r = await get_driver(host.type).summary_async(f"{host.ip}:{host.port}", host.user, host.password, timeout)
+            health_tracker.record_success(host.ip, time.monotonic() - started)
+            record_host_hashrate(host.ip, r)
+        except Exception:
+            health_tracker.record_failure(host.ip)
+            r = {'success': False, 'error': 'Cannot connect to the ASIC'}
+
+    # Adding ASIC id to response
+    r['id'] = asic_id
+
+    with asics_info_lock:
+        asics_info_cache[asic_id] = r
+
+    return r
+
+
+async def poll_asics(ids, use_cache=True):
+    """
+    Polls ASICs concurrently
+    ASICs with non-blocking drivers (CGMiner) are polled from the event loop, the rest from worker threads
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=36))
+
+    return await asyncio.gather(*[query_asic(asic_id, use_cache) for asic_id in ids])
+
+
 def fetch_asics_info():
     with orm.db_session:
         hosts = Hosts.select()
-        pool = ThreadPoolExecutor(max_workers=36)
         ids = []
 
         for host in hosts:
             ids.append(host.id)
 
-    responses = pool.map(get_asic_info, ids)
-    pool.shutdown()
-
-    # Fetching all data from generator
-    results = [x for x in responses]
+    results = asyncio.run(poll_asics(ids))
 
     # Dumping JSON
     return json.dumps(results)
 
 
+def get_fleet_snapshot():
+    """
+    Returns available power and status, hashrate and temperature of all ASICs
+    """
+    fields = {field['id']: field for field in json.loads(fetch_asics_info()) if 'id' in field}
+    asics = {}
+
+    with orm.db_session:
+        for host in Hosts.select():
+            field = fields.get(host.id, {})
+            reachable = field.get('success') is not False and 'id' in field
+            hashrate = None
+            temperature = None
+
+            if reachable and 'TotalHash' in field and field['TotalHash']['Unit'] == 'TH/s':
+                hashrate = field['TotalHash']['Hash Rate']
+
+            if reachable and field.get('DEVS'):
+                temperature = max((dev['Temperature'] for dev in field['DEVS'] if 'Temperature' in dev), default=None)
+
+            asics[str(host.id)] = {
+                'ip': host.ip,
+                'online': host.online,
+                'reachable': reachable,
+                'hashrate': hashrate,
+                'temperature': temperature
+            }
+
+    return {
+        'available_power': get_state('available_power', 0),
+        'asics': asics
+    }
+
+
+def diff_fleet_snapshots(old, new):
+    """
+    Returns a list of events (type, data) turning an old fleet snapshot into a new one
+    Hashrate and temperature are compared with thresholds, so small fluctuations aren't sent
+    """
+    events = []
+
+    if old['available_power'] != new['available_power']:
+        events.append(('available_power', {'power': new['available_power']}))
+
+    for asic_id, asic in new['asics'].items():
+        previous = old['asics'].get(asic_id)
+
+        if previous is None:
+            events.append(('asic', dict(asic, id=asic_id)))
+            continue
+
+        changes = {key: asic[key] for key in ('ip', 'online', 'reachable') if asic[key] != previous[key]}
+
+        for key, threshold in (('hashrate', HASHRATE_CHANGE_THRESHOLD), ('temperature', TEMPERATURE_CHANGE_THRESHOLD)):
+            if (asic[key] is None) != (previous[key] is None) or \
+                    (asic[key] is not None and abs(asic[key] - previous[key]) >= threshold):
+                changes[key] = asic[key]
+
+        if changes:
+            events.append(('asic', dict(changes, id=asic_id)))
+
+    for asic_id in old['asics'].keys() - new['asics'].keys():
+        events.append(('asic_removed', {'id': asic_id}))
+
+    return events
+
+
+def apply_fleet_event(state, event, data):
+    """
+    Applies an event to fleet state
+    """
+    if event == 'available_power':
+        state['available_power'] = data['power']
+    elif event == 'asic':
+        asic = {key: value for key, value in data.items() if key != 'id'}
+        state['asics'].setdefault(data['id'], {}).update(asic)
+    elif event == 'asic_removed':
+        state['asics'].pop(data['id'], None)
+
+
+class FleetEvents:
+    """
+    Streams fleet changes to clients of a worker process
+    Events are numbered and kept in DB, so a client can resume on any worker. Fleet state is checked by one worker
+    at a time (the one holding the lease) while it has clients, other workers read its events from DB
+    """
+    def __init__(self):
+        self.worker = f"{os.getpid()}.{time.time_ns()}"
+        # Event ids are unique to DB, clients coming with ids from another DB get a snapshot
+        self.epoch = None
+        # The last event sent to clients of the worker
+        self.seq = None
+        self.ready = asyncio.Event()
+        self.clients = []
+        self.task = None
+
+    async def run(self):
+        """
+        Produces fleet changes while holding the lease and sends new events to clients while there are clients
+        """
+        version = 0
+
+        try:
+            while self.clients:
+                try:
+                    if await asyncio.to_thread(self.acquire_lease):
+                        snapshot = await asyncio.to_thread(get_fleet_snapshot)
+                        await asyncio.to_thread(self.store, snapshot)
+
+                    for item in await asyncio.to_thread(self.get_new_events):
+                        self.publish(item)
+
+                    if self.seq is not None:
+                        self.ready.set()
+                except Exception as e:
+                    logging.error(f"Error while checking fleet state: {e}")
+
+                # Checking again after the interval or as soon as available power changes
+                version = await wait_for_state_change(version, EVENTS_INTERVAL, keys=['available_power'])
+        finally:
+            # Letting another worker take over and starting from the current state on the next run
+            self.release_lease()
+            self.seq = None
+            self.ready.clear()
+
+    def acquire_lease(self):
+        """
+        Takes or renews the lease for checking fleet state, returns True if the worker holds it
+        """
+        now = time.time()
+
+        with orm.db_session(serializable=True):
+            fleet = FleetState.get(id=1) or FleetState(id=1, epoch=str(int(now)), seq=0, lease=0)
+
+            if fleet.producer != self.worker and fleet.lease > now:
+                return False
+
+            fleet.producer = self.worker
+            fleet.lease = now + EVENTS_LEASE_TIMEOUT
+
+            return True
+
+    def release_lease(self):
+        """
+        Gives up the lease for checking fleet state
+        """
+        with orm.db_session(serializable=True):
+            fleet = FleetState.get(id=1)
+
+            if fleet and fleet.producer == self.worker:
+                fleet.lease = 0
+
+    def store(self, snapshot):
+        """
+        Writes changes between stored fleet state and a snapshot as numbered events, the oldest events are deleted
+        """
+        with orm.db_session(serializable=True):
+            fleet = FleetState[1]
+
+            # Another worker has taken over in the meantime
+            if fleet.producer != self.worker:
+                return
+
+            if not fleet.value:
+                fleet.value = snapshot
+                return
+
+            state = json.loads(json.dumps(fleet.value))
+
+            for event, data in diff_fleet_snapshots(state, snapshot):
+                apply_fleet_event(state, event, data)
+                fleet.seq += 1
+                FleetEventLog(seq=fleet.seq, event=event, data=data)
+
+            fleet.value = state
+            oldest = fleet.seq - EVENTS_LOG_SIZE
+            FleetEventLog.select(lambda e: e.seq <= oldest).delete(bulk=True)
+
+    def get_new_events(self):
+        """
+        Returns events written after the last one sent to clients of the worker
+        """
+        with orm.db_session:
+            fleet = FleetState.get(id=1)
+
+            if fleet is None or not fleet.value:
+                return []
+
+            # Starting from the current state or after DB has been recreated
+            if self.seq is None or fleet.epoch != self.epoch or fleet.seq < self.seq:
+                self.epoch = fleet.epoch
+                self.seq = fleet.seq
+                return []
+
+        events = self.get_events_after(self.seq)
+
+        # Events which have been deleted before the worker has read them are replaced with a snapshot
+        if events and events[0][0] != self.seq + 1:
+            for client in self.clients:
+                client['lagging'] = True
+
+        if events:
+            self.seq = events[-1][0]
+
+        return events
+
+    def get_events_after(self, seq):
+        """
+        Returns events after the given event id which are kept in DB
+        """
+        with orm.db_session:
+            events = FleetEventLog.select(lambda e: e.seq > seq).order_by(FleetEventLog.seq)
+
+            return [(event.seq, event.event, event.data) for event in events]
+
+    def get_state(self):
+        """
+        Returns the last event id and fleet state as it has been sent to clients
+        """
+        with orm.db_session:
+            fleet = FleetState[1]
+
+            return fleet.seq, json.loads(json.dumps(fleet.value))
+
+    def publish(self, item):
+        """
+        Queues an event for all clients, events for lagging clients are dropped
+        """
+        for client in self.clients:
+            if client['lagging']:
+                continue
+
+            try:
+                client['queue'].put_nowait(item)
+            except asyncio.QueueFull:
+                client['lagging'] = True
+
+    def format(self, seq, event, data):
+        """
+        Formats a server-sent event
+        """
+        return f"id: {self.epoch}-{seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def get_missed_events(self, last_event_id):
+        """
+        Returns events after the given event id or None if they aren't kept anymore
+        """
+        epoch, _, seq = (last_event_id or '').rpartition('-')
+
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+
+        with orm.db_session:
+            current = FleetState[1].seq
+
+        last = int(seq)
+
+        if last > current:
+            return None
+
+        missed = self.get_events_after(last)
+
+        # Checking that no events have been dropped from the log since then
+        if last < current and (not missed or missed[0][0] != last + 1):
+            return None
+
+        return missed
+
+    async def stream(self, last_event_id=None):
+        """
+        Generates server-sent events for a client: missed events or a snapshot followed by new events
+        """
+        client = {'queue': asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE), 'lagging': False, 'seq': 0}
+        self.clients.append(client)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+        try:
+            try:
+                await asyncio.wait_for(self.ready.wait(), EVENTS_READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                # The client reconnects after the retry interval
+                error = {'error': 'Fleet state is unavailable'}
+                yield f"retry: {int(EVENTS_READY_TIMEOUT * 1000)}\nevent: unavailable\ndata: {json.dumps(error)}\n\n"
+                return
+
+            missed = await asyncio.to_thread(self.get_missed_events, last_event_id)
+
+            if missed is None:
+                client['seq'], state = await asyncio.to_thread(self.get_state)
+                yield self.format(client['seq'], 'snapshot', state)
+            else:
+                client['seq'] = int(last_event_id.rpartition('-')[2])
+
+                for item in missed:
+                    client['seq'] = item[0]
+                    yield self.format(*item)
+
+            while True:
+                try:
+                    item = await asyncio.wait_for(client['queue'].get(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                # Skipping events which have already been sent with the snapshot or missed events
+                if item[0] > client['seq']:
+                    client['seq'] = item[0]
+                    yield self.format(*item)
+
+                # Sending a lagging client the current state once it has caught up with the queue
+                if client['lagging'] and client['queue'].empty():
+                    client['lagging'] = False
+                    client['seq'], state = await asyncio.to_thread(self.get_state)
+                    yield self.format(client['seq'], 'snapshot', state)
+        finally:
+            self.clients.remove(client)
+
+
+fleet_events = FleetEvents()
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8080)
+    # Number of worker processes, the same variable is used by uvicorn CLI
+    uvicorn.run("api:app", host="127.0.0.1", port=8080, workers=int(os.getenv('WEB_CONCURRENCY') or 1))
@@ -0,0 +1,133 @@
+"""
+Health of ASICs (a circuit breaker), shared by ASIC-agent and API which keep it in the same HostHealth table
+Settings are read from HEALTH_* environment variables, so both services consider an ASIC unreachable at the same time
+"""
+import os
+import time
+from pony import orm
+
+# Number of consecutive failures after which an ASIC is considered unreachable
+HEALTH_FAILURE_THRESHOLD = 3
+# Delay before probing an unreachable ASIC again, doubled after every failed probe (in seconds)
+HEALTH_BACKOFF = 30
+# Maximum delay between probes of an unreachable ASIC (in seconds)
+HEALTH_BACKOFF_MAX = 600
+# Timeout for probing an unreachable ASIC
+HEALTH_PROBE_TIMEOUT = 1
+# Smoothing factor of ASIC's latency average
+HEALTH_LATENCY_ALPHA = 0.3
+
+
+class HostHealthTracker:
+    """
+    Counts failures of ASICs, skips unreachable ones and schedules their probes with exponential backoff
+    """
+    def __init__(self, entity, timeout):
+        """
+        Parameters
+        ----------
+        entity
+            HostHealth entity of the service's DB
+        timeout
+            Timeout for accessing a healthy ASIC
+        """
+        self.entity = entity
+        self.timeout = timeout
+        self.failure_threshold = int(os.getenv('HEALTH_FAILURE_THRESHOLD')) \
+            if os.getenv('HEALTH_FAILURE_THRESHOLD') else HEALTH_FAILURE_THRESHOLD
+        self.backoff = int(os.getenv('HEALTH_BACKOFF')) if os.getenv('HEALTH_BACKOFF') else HEALTH_BACKOFF
+        self.backoff_max = int(os.getenv('HEALTH_BACKOFF_MAX')) if os.getenv('HEALTH_BACKOFF_MAX') \
+            else HEALTH_BACKOFF_MAX
+        self.probe_timeout = int(os.getenv('HEALTH_PROBE_TIMEOUT')) if os.getenv('HEALTH_PROBE_TIMEOUT') \
+            else HEALTH_PROBE_TIMEOUT
+        self.latency_alpha = float(os.getenv('HEALTH_LATENCY_ALPHA')) if os.getenv('HEALTH_LATENCY_ALPHA') \
+            else HEALTH_LATENCY_ALPHA
+
+    def get_status(self, health):
+        """
+        Returns a status of an ASIC (unknown / healthy / failing / unreachable) by its HostHealth entry
+        """
+        if not health:
+            return 'unknown'
+
+        if health.failures == 0:
+            return 'healthy'
+
+        if health.failures < self.failure_threshold:
+            return 'failing'
+
+        return 'unreachable'
+
+    @orm.db_session
+    def get_unreachable(self):
+        """
+        Returns a set of IPs of unreachable ASICs
+        """
+        threshold = self.failure_threshold
+
+        return set(orm.select(h.ip for h in self.entity if h.failures >= threshold))
+
+    @orm.db_session
+    def get_timeout(self, ip):
+        """
+        Returns a timeout for accessing an ASIC
+        Unreachable ASICs are skipped until their next probe, probes use a short timeout
+
+        Parameters
+        ----------
+        ip
+            ASIC's IP
+
+        Returns
+        -------
+        timeout
+            A timeout (in seconds) or None if the ASIC should be skipped
+        """
+        health = self.entity.get(ip=ip)
+
+        if not health or health.failures < self.failure_threshold:
+            return self.timeout
+
+        if time.time() < health.next_probe:
+            return None
+
+        return self.probe_timeout
+
+    @orm.db_session
+    def record_success(self, ip, latency):
+        """
+        Resets ASIC's failures and updates its latency average
+
+        Parameters
+        ----------
+        ip
+            ASIC's IP
+        latency
+            A duration of the request (in seconds)
+        """
+        health = self.entity.get(ip=ip) or self.entity(ip=ip, failures=0, next_probe=0)
+
+        health.failures = 0
+        health.next_probe = 0
+        health.last_success = time.time()
+        health.latency = latency if health.latency is None else \
+            self.latency_alpha * latency + (1 - self.latency_alpha) * health.latency
+
+    @orm.db_session
+    def record_failure(self, ip):
+        """
+        Counts ASIC's failure and schedules the next probe with exponential backoff
+
+        Parameters
+        ----------
+        ip
+            ASIC's IP
+        """
+        health = self.entity.get(ip=ip) or self.entity(ip=ip, failures=0, next_probe=0)
+
+        health.failures += 1
+        health.last_failure = time.time()
+
+        if health.failures >= self.failure_threshold:
+            backoff = self.backoff * 2 ** (health.failures - self.failure_threshold)
+            health.next_probe = health.last_failure + min(backoff, self.backoff_max)
@@ -0,0 +1,297 @@
+"""
+Drivers for ASICs' APIs, a driver is selected by ASIC's type (Hosts.type)
+This module is shared by ASIC-agent and API, it is copied into both images (see Dockerfiles)
+"""
+import json
+import asyncio
+import threading
+import requests
+
+
+class DragonClient:
+    """
+    DragonMint/Innosilicon REST API client
+    Keeps its token (JWT) and a keep-alive connection to the ASIC between calls, the token is refreshed when expired
+    """
+    def __init__(self, host, username, password):
+        self.base_url = f"http://{host}"
+        self.username = username
+        self.password = password
+        self.jwt = None
+        self.session = requests.Session()
+        # Calls to the same ASIC are made one at a time
+        self.lock = threading.Lock()
+
+    def auth(self, timeout):
+        """
+        Authenticates with the ASIC and obtains a token
+
+        Parameters
+        ----------
+        timeout
+            Timeout for accessing ASIC
+        """
+        response = self.session.post(
+            f"{self.base_url}/api/auth",
+            data={'username': self.username, 'password': self.password},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        if 'jwt' not in data:
+            raise ValueError("Not authorized: didn't receive token, check username or password")
+
+        self.jwt = data['jwt']
+
+    def post(self, path, timeout):
+        """
+        Sends a request to the ASIC, authenticating first if there's no valid token
+
+        Parameters
+        ----------
+        path
+            API path
+        timeout
+            Timeout for accessing ASIC
+
+        Returns
+        -------
+        data
+            Parsed response
+        """
+        with self.lock:
+            if self.jwt is None:
+                self.auth(timeout)
+
+            for attempt in range(2):
+                response = self.session.post(
+                    f"{self.base_url}{path}",
+                    headers={'Authorization': f"Bearer {self.jwt}"},
+                    timeout=timeout
+                )
+
+                if response.status_code not in (401, 403):
+                    response.raise_for_status()
+                    data = response.json()
+
+                    if data.get('success', True) or data.get('token') != 'expired':
+                        return data
+
+                # Refreshing the token and retrying once
+                self.jwt = None
+                self.auth(timeout)
+
+            raise ValueError("Not authorized: token has expired")
+
+    def summary(self, timeout):
+        """
+        Fetches DEVS, POOLS and Fan Speed from the CGMiner API
+        """
+        return self.post('/api/summary', timeout)
+
+    def restart_cgminer(self, timeout):
+        """
+        Restarts CGMiner
+        """
+        return self.post('/api/restartCgMiner', timeout)
+
+    def close(self):
+        """
+        Closes connections to the ASIC
+        """
+        self.session.close()
+
+
+# Clients by ASIC's address (ip:port)
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_dragon_client(host, username, password):
+    """
+    Returns a client for an ASIC, a new client is created when credentials have changed
+
+    Parameters
+    ----------
+    host
+        ASIC's address (ip:port)
+    username
+        ASIC's username
+    password
+        ASIC's password
+
+    Returns
+    -------
+    client
+        A client for the ASIC
+    """
+    with clients_lock:
+        client = clients.get(host)
+
+        if client is None or client.username != username or client.password != password:
+            if client is not None:
+                client.close()
+
+            client = DragonClient(host, username, password)
+            clients[host] = client
+
+    return client
+
+
+def invalidate_dragon_client(host):
+    """
+    Drops a client for an ASIC (e.g. when the ASIC has been updated or deleted)
+
+    Parameters
+    ----------
+    host
+        ASIC's address (ip:port)
+    """
+    with clients_lock:
+        client = clients.pop(host, None)
+
+    if client is not None:
+        client.close()
+
+
+class DragonDriver:
+    """
+    Driver for DragonMint/Innosilicon ASICs (REST API with login, port 80)
+    """
+    def summary(self, host, username, password, timeout):
+        """
+        Fetches DEVS, POOLS and TotalHash of an ASIC
+        """
+        return get_dragon_client(host, username, password).summary(timeout)
+
+    async def summary_async(self, host, username, password, timeout):
+        """
+        Fetches a summary of an ASIC in a worker thread
+        """
+        return await asyncio.to_thread(self.summary, host, username, password, timeout)
+
+    def restart(self, host, username, password, timeout):
+        """
+        Restarts CGMiner
+        """
+        return get_dragon_client(host, username, password).restart_cgminer(timeout)
+
+
+class CgminerDriver:
+    """
+    Driver for ASICs with CGMiner JSON API over TCP (port 4028, no login)
+    Requests are made with non-blocking sockets, so many ASICs can be polled concurrently from one thread
+    """
+    async def command(self, host, command, timeout):
+        """
+        Sends a command to CGMiner API
+
+        Parameters
+        ----------
+        host
+            ASIC's address (ip:port)
+        command
+            CGMiner API command
+        timeout
+            Timeout for accessing ASIC
+
+        Returns
+        -------
+        data
+            Parsed response
+        """
+        ip, port = host.rsplit(':', 1)
+
+        async def exchange():
+            reader, writer = await asyncio.open_connection(ip, int(port))
+
+            try:
+                writer.write(json.dumps({'command': command}).encode())
+                await writer.drain()
+
+                # CGMiner closes the connection after the response
+                return await reader.read()
+            finally:
+                writer.close()
+
+        response = (await asyncio.wait_for(exchange(), timeout)).rstrip(b'\x00').decode()
+
+        try:
+            data = json.loads(response)
+        except ValueError:
+            # Some commands (e.g. restart) may be answered with plain text
+            return {'STATUS': response}
+
+        for status in data.get('STATUS', []):
+            if status.get('STATUS') in ('E', 'F'):
+                raise ValueError(f"CGMiner API error: {status.get('Msg')}")
+
+        return data
+
+    async def summary_async(self, host, username, password, timeout):
+        """
+        Fetches a summary of an ASIC converted to the format of DragonMint API (DEVS, TotalHash)
+        """
+        summary, devs = await asyncio.gather(
+            self.command(host, 'summary', timeout),
+            self.command(host, 'devs', timeout)
+        )
+
+        summary = summary['SUMMARY'][0]
+
+        # Converting average hashrate to TH/s
+        if 'GHS av' in summary:
+            hashrate = summary['GHS av'] / 1000
+        else:
+            hashrate = summary.get('MHS av', 0) / 1000000
+
+        boards = []
+
+        for index, dev in enumerate(devs.get('DEVS', [])):
+            dev.setdefault('ID', dev.get('ASC', index))
+            dev.setdefault('Temperature', 0)
+            boards.append(dev)
+
+        return {
+            'success': True,
+            'SUMMARY': summary,
+            'DEVS': boards,
+            'TotalHash': {'Hash Rate': hashrate, 'Unit': 'TH/s'}
+        }
+
+    def summary(self, host, username, password, timeout):
+        """
+        Fetches a summary of an ASIC
+        """
+        return asyncio.run(self.summary_async(host, username, password, timeout))
+
+    def restart(self, host, username, password, timeout):
+        """
+        Restarts CGMiner, requires privileged access to CGMiner API
+        """
+        return asyncio.run(self.command(host, 'restart', timeout))
+
+
+# Drivers by ASIC's type
+drivers = {
+    'DragonAPI': DragonDriver(),
+    'cgminer': CgminerDriver()
+}
+
+
+def get_driver(asic_type):
+    """
+    Returns a driver for an ASIC's type, DragonMint driver is used for unknown types
+
+    Parameters
+    ----------
+    asic_type
+        ASIC's type (Hosts.type)
+
+    Returns
+    -------
+    driver
+        A driver for the ASIC
+    """
+    return drivers.get(asic_type, drivers['DragonAPI'])
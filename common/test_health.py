@@ -0,0 +1,80 @@
+"""
+Tests for the health tracker of ASICs
+"""
+import time
+import pytest
+from pony import orm
+from health import HostHealthTracker
+
+db = orm.Database()
+db.bind(provider='sqlite', filename=':memory:')
+
+
+class HostHealth(db.Entity):
+    ip = orm.PrimaryKey(str)
+    failures = orm.Required(int)
+    last_success = orm.Optional(float)
+    last_failure = orm.Optional(float)
+    latency = orm.Optional(float)
+    next_probe = orm.Required(float)
+
+
+db.generate_mapping(create_tables=True)
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    monkeypatch.setenv('HEALTH_FAILURE_THRESHOLD', '2')
+    monkeypatch.setenv('HEALTH_BACKOFF', '10')
+    monkeypatch.setenv('HEALTH_BACKOFF_MAX', '15')
+
+    with orm.db_session:
+        HostHealth.select().delete(bulk=True)
+
+    return HostHealthTracker(HostHealth, 5)
+
+
+def test_unreachable_after_threshold(tracker):
+    tracker.record_failure('10.0.0.1')
+
+    assert tracker.get_timeout('10.0.0.1') == 5
+    assert tracker.get_unreachable() == set()
+
+    tracker.record_failure('10.0.0.1')
+
+    # Skipped until the next probe
+    assert tracker.get_timeout('10.0.0.1') is None
+    assert tracker.get_unreachable() == {'10.0.0.1'}
+
+    with orm.db_session:
+        assert HostHealth['10.0.0.1'].next_probe == pytest.approx(time.time() + 10, abs=1)
+        assert tracker.get_status(HostHealth['10.0.0.1']) == 'unreachable'
+
+
+def test_backoff_is_capped(tracker):
+    for _ in range(5):
+        tracker.record_failure('10.0.0.1')
+
+    with orm.db_session:
+        health = HostHealth['10.0.0.1']
+        assert health.next_probe - health.last_failure == 15
+
+
+def test_probe_and_recovery(tracker):
+    tracker.record_failure('10.0.0.1')
+    tracker.record_failure('10.0.0.1')
+
+    with orm.db_session:
+        HostHealth['10.0.0.1'].next_probe = time.time() - 1
+
+    # Probes use a short timeout
+    assert tracker.get_timeout('10.0.0.1') == 1
+
+    tracker.record_success('10.0.0.1', 0.2)
+
+    assert tracker.get_timeout('10.0.0.1') == 5
+
+    with orm.db_session:
+        health = HostHealth['10.0.0.1']
+        assert tracker.get_status(health) == 'healthy'
+        assert health.latency == 0.2
@@ -0,0 +1,91 @@
+"""
+Tests for CGMiner driver against a fake CGMiner API server
+"""
+import json
+import asyncio
+import threading
+import pytest
+from miners import get_driver
+
+# Responses of the fake CGMiner API by command
+RESPONSES = {
+    'summary': {
+        'STATUS': [{'STATUS': 'S', 'Msg': 'Summary'}],
+        'SUMMARY': [{'Elapsed': 3600, 'GHS av': 13500.0}]
+    },
+    'devs': {
+        'STATUS': [{'STATUS': 'S', 'Msg': '3 ASC(s)'}],
+        'DEVS': [
+            {'ASC': 0, 'Temperature': 65.0},
+            {'ASC': 1, 'Temperature': 67.5},
+            {'ASC': 2}
+        ]
+    },
+    'restart': {
+        'STATUS': [{'STATUS': 'S', 'Msg': 'Restarting'}]
+    }
+}
+
+
+@pytest.fixture
+def cgminer():
+    """
+    Runs a fake CGMiner API server in a separate thread and returns its address (ip:port) and received commands
+    """
+    loop = asyncio.new_event_loop()
+    commands = []
+
+    async def handle(reader, writer):
+        command = json.loads(await reader.read(1024))['command']
+        commands.append(command)
+
+        if command in RESPONSES:
+            response = RESPONSES[command]
+        else:
+            response = {'STATUS': [{'STATUS': 'E', 'Msg': 'Invalid command'}]}
+
+        # CGMiner terminates responses with NUL and closes the connection
+        writer.write(json.dumps(response).encode() + b'\x00')
+        await writer.drain()
+        writer.close()
+
+    server = loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield f"127.0.0.1:{port}", commands
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+def test_summary_async(cgminer):
+    host, commands = cgminer
+
+    data = asyncio.run(get_driver('cgminer').summary_async(host, None, None, 1))
+
+    assert data['success'] is True
+    assert data['TotalHash'] == {'Hash Rate': 13.5, 'Unit': 'TH/s'}
+    assert [dev['ID'] for dev in data['DEVS']] == [0, 1, 2]
+    assert [dev['Temperature'] for dev in data['DEVS']] == [65.0, 67.5, 0]
+    assert sorted(commands) == ['devs', 'summary']
+
+
+def test_restart(cgminer):
+    host, commands = cgminer
+
+    data = get_driver('cgminer').restart(host, None, None, 1)
+
+    assert data['STATUS'][0]['Msg'] == 'Restarting'
+    assert commands == ['restart']
+
+
+def test_error_status(cgminer):
+    host, commands = cgminer
+
+    with pytest.raises(ValueError, match='Invalid command'):
+        asyncio.run(get_driver('cgminer').command(host, 'quit', 1))